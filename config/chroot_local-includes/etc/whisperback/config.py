@@ -9,12 +9,16 @@
 # IMPORTS
 
 # Custom imports
+import codecs
+import functools
 import os
 import subprocess
 import random
 import re
 import locale
 import gettext
+import threading
+import time
 
 # DOCUMENTATION
 
@@ -52,13 +56,22 @@ def __get_localised_doc_link():
         localised_doc_language +
         ".html")
 
+@functools.lru_cache(maxsize=None)
+def __get_translation():
+    """Return the translation catalog, or None if there is none"""
+    try:
+        return gettext.translation("tails", "/usr/share/locale")
+    except IOError:
+        return None
+
+@functools.lru_cache(maxsize=None)
 def _(string):
+    translation = __get_translation()
+    if translation is None:
+        return string
     try:
-        encoded = gettext.translation("tails", "/usr/share/locale").lgettext(string)
-        string  = encoded.decode('utf-8')
+        return translation.lgettext(string).decode('utf-8')
     except IOError:
-        pass
-    finally:
         return string
 
 # The right panel help (HTML string)
@@ -157,6 +170,103 @@ def mail_prepended_info():
     
     return "Tails-Version: %s\n" % tails_version
 
+# The maximum size of the debugging information appended to the email,
+# in characters
+DEBUGGING_INFO_MAX_SIZE = 16 * 1024 * 1024
+
+# The debugging information is collected when WhisperBack starts, but
+# users often reproduce the bug they report while writing the report:
+# if it is sent more than this many seconds later, the Journal entries
+# logged after the cursor that ends the debugging information (or, if
+# it was cut short, since it was collected) are appended, up to
+# JOURNAL_TAIL_MAX_SIZE characters
+JOURNAL_REFRESH_DELAY = 10
+JOURNAL_TAIL_MAX_SIZE = 8 * 1024 * 1024
+
+class DebuggingInfoCollector(threading.Thread):
+    """Collects debugging information on the running Tails system in
+    the background, so that it is ready by the time the report is sent
+    """
+
+    # Strips the leading "--" of each line, including the newline of
+    # the lines that only contain "--"
+    line_prefix_re = re.compile(r'^--[^\S\n]*\n?', re.MULTILINE)
+
+    # The last line printed by "journalctl --show-cursor"
+    cursor_re = re.compile(r'-- cursor: (\S+)\n')
+
+    def __init__(self, args=(), max_size=DEBUGGING_INFO_MAX_SIZE):
+        super().__init__(daemon=True)
+        self.args = args
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+        self.started = None
+        self.cursor = None
+        self.truncated = False
+
+    def append(self, text):
+        """Appends text, up to max_size
+
+        @return False if text had to be truncated
+        """
+        text = self.line_prefix_re.sub('', text)
+        if self.size + len(text) > self.max_size:
+            self.chunks.append(text[:self.max_size - self.size])
+            self.chunks.append("\n[debugging information truncated to "
+                               "%i characters]\n" % self.max_size)
+            self.size = self.max_size
+            return False
+        self.chunks.append(text)
+        self.size += len(text)
+        return True
+
+    def run(self):
+        self.started = time.time()
+        try:
+            process = subprocess.Popen (["sudo", "/usr/local/sbin/tails-debugging-info"] + list(self.args),
+                                        stdout=subprocess.PIPE)
+        except OSError:
+            self.chunks.append("sudo command not found\n")
+            return
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pending = ""
+        last_line = ""
+        with process.stdout:
+            for data in iter(lambda: process.stdout.read1(65536), b''):
+                # Only process complete lines, so that line_prefix_re
+                # matches whole lines
+                text = pending + decoder.decode(data)
+                lines_end = text.rfind("\n") + 1
+                pending = text[lines_end:]
+                if lines_end:
+                    last_line = text[text.rfind("\n", 0, lines_end - 1) + 1:
+                                     lines_end]
+                if not self.append(text[:lines_end]):
+                    self.truncated = True
+                    break
+            else:
+                self.append(pending + decoder.decode(b'', final=True))
+                match = self.cursor_re.fullmatch(last_line + pending)
+                if match:
+                    self.cursor = match.group(1)
+        process.wait()
+        # Once truncated, we closed the pipe and the command fails to
+        # write to it, as intended
+        if process.returncode > 0 and not self.truncated:
+            self.chunks.append("debugging command returned an error\n")
+
+    def result(self):
+        """Waits for the collection to finish
+
+        @return a long string containing debugging information
+        """
+        self.join()
+        return "".join(self.chunks)
+
+__debugging_info_collector = DebuggingInfoCollector()
+__debugging_info_collector.start()
+
 # A callback function to get information to append to the email
 # (this information will be encrypted). This is useful to add
 # configuration files useful for debugging.
@@ -168,16 +278,17 @@ def mail_appended_info():
     
     @return a long string containing debugging information
     """
-    debugging_info = ""
-
-    try:
-        process = subprocess.Popen (["sudo", "/usr/local/sbin/tails-debugging-info"], 
-                                    stdout=subprocess.PIPE)
-        for line in process.stdout:
-            debugging_info += re.sub(r'^--\s*', '', line.decode('utf-8'))
-        process.wait()
-    except OSError:
-        debugging_info += "sudo command not found\n"
-    except subprocess.CalledProcessError:
-        debugging_info += "debugging command returned an error\n"
+    debugging_info = __debugging_info_collector.result()
+    started = __debugging_info_collector.started
+    cursor = __debugging_info_collector.cursor
+    if started is not None and \
+       time.time() - started > JOURNAL_REFRESH_DELAY:
+        if cursor is not None:
+            args = ["--journal-after-cursor", cursor]
+        else:
+            args = ["--journal-since", str(int(started))]
+        journal_tail = DebuggingInfoCollector(
+            args, max_size=JOURNAL_TAIL_MAX_SIZE)
+        journal_tail.start()
+        debugging_info += journal_tail.result()
     return debugging_info
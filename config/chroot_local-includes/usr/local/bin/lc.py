@@ -33,11 +33,268 @@
 # The datafile should be a bunch of words from some language
 # with minimal punctuation or garbage (# starts a comment). 
 
+from array import array
+from bisect import bisect_right
+from collections import Counter, deque
 from optparse import OptionParser
+import mmap
 import random
 import re
+import struct
 import sys
 
+class CompiledModel:
+    """A pseudolanguage's letter pair Markov chain, in compact arrays
+
+    The states are the letter pairs seen in the data, in sorted order;
+    state i is the pair alphabet[pair_chars[2*i]] +
+    alphabet[pair_chars[2*i+1]]. Its successors are the edges
+    offsets[i] to offsets[i+1]-1: edge e appends alphabet[chars[e]] to
+    the word and leads to state next_states[e], or ends the word if
+    that is END. cumulative[e] is the sum of the weights of the state's
+    edges up to e. A word starts with any of the pairs listed in inits,
+    with the same probability."""
+
+    MAGIC = b'LCMODEL\0'
+    VERSION = 1
+    # magic, version, and the lengths of alphabet, states, edges, inits
+    HEADER = struct.Struct('<8sIIIII4x')
+    END = 0xffffffff
+
+    def __init__(self, alphabet, pair_chars, offsets, next_states, chars,
+                 cumulative, inits):
+        self.alphabet = alphabet
+        self.pair_chars = pair_chars
+        self.offsets = offsets
+        self.next_states = next_states
+        self.chars = chars
+        self.cumulative = cumulative
+        self.inits = inits
+        self._remaining = None
+
+    @classmethod
+    def from_counts(cls, inits, pairs):
+        """Compile a set of initial pairs, and a dict mapping pairs to
+        lists of (successor, count) sorted by successor"""
+        states = sorted(pairs)
+        state_ids = dict((pair, i) for i, pair in enumerate(states))
+        alphabet = sorted(set(''.join(states)) |
+                          set(c for successors in pairs.values()
+                              for c, _ in successors))
+        char_ids = dict((c, i) for i, c in enumerate(alphabet))
+        pair_chars = array('I', (char_ids[c] for pair in states
+                                 for c in pair))
+        offsets = array('I', [0])
+        next_states = array('I')
+        chars = array('I')
+        cumulative = array('I')
+        for pair in states:
+            total = 0
+            for c, count in pairs[pair]:
+                total += count
+                next_states.append(cls.END if c == ' '
+                                   else state_ids[pair[1] + c])
+                chars.append(char_ids[c])
+                cumulative.append(total)
+            offsets.append(len(chars))
+        inits = array('I', sorted(state_ids[pair] for pair in inits))
+        return cls(alphabet, pair_chars, offsets, next_states, chars,
+                   cumulative, inits)
+
+    def save(self, path):
+        """Save the model to a binary file"""
+        alphabet = array('I', (ord(c) for c in self.alphabet))
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION,
+                                     len(alphabet), len(self.offsets) - 1,
+                                     len(self.chars), len(self.inits)))
+            for values in (alphabet, self.pair_chars, self.offsets,
+                           self.next_states, self.chars, self.cumulative,
+                           self.inits):
+                values = array('I', values)
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                f.write(values.tobytes())
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a model saved with save()"""
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(data) < cls.HEADER.size:
+            raise ValueError("%s: not a compiled pseudolanguage" % path)
+        magic, version, n_chars, n_states, n_edges, n_inits = \
+            cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError("%s: not a compiled pseudolanguage" % path)
+        if version != cls.VERSION:
+            raise ValueError("%s: unsupported version %d" % (path, version))
+        lengths = (n_chars, 2 * n_states, n_states + 1, n_edges, n_edges,
+                   n_edges, n_inits)
+        if len(data) != cls.HEADER.size + 4 * sum(lengths):
+            raise ValueError("%s: truncated compiled pseudolanguage" % path)
+        views = []
+        offset = cls.HEADER.size
+        for length in lengths:
+            view = memoryview(data)[offset:offset + 4 * length].cast('I')
+            if sys.byteorder != 'little':
+                view = array('I', view)
+                view.byteswap()
+            views.append(view)
+            offset += 4 * length
+        alphabet = [chr(c) for c in views[0]]
+        return cls(alphabet, *views[1:])
+
+    def pair(self, state):
+        """Return the letter pair of a state"""
+        return self.alphabet[self.pair_chars[2 * state]] + \
+            self.alphabet[self.pair_chars[2 * state + 1]]
+
+    def successors(self, state):
+        """Return a dict mapping each successor of a state to its weight"""
+        successors = {}
+        previous = 0
+        for e in range(self.offsets[state], self.offsets[state + 1]):
+            successors[self.alphabet[self.chars[e]]] = \
+                self.cumulative[e] - previous
+            previous = self.cumulative[e]
+        return successors
+
+    def remaining(self):
+        """Return, for each state, the least number of letters a word
+        reaching it will still get"""
+        if self._remaining is None:
+            n_states = len(self.offsets) - 1
+            predecessors = [[] for _ in range(n_states)]
+            remaining = [None] * n_states
+            queue = deque()
+            for state in range(n_states):
+                for e in range(self.offsets[state], self.offsets[state + 1]):
+                    if self.next_states[e] == self.END:
+                        if remaining[state] is None:
+                            remaining[state] = 0
+                            queue.append(state)
+                    else:
+                        predecessors[self.next_states[e]].append(state)
+            while queue:
+                state = queue.popleft()
+                for predecessor in predecessors[state]:
+                    if remaining[predecessor] is None:
+                        remaining[predecessor] = remaining[state] + 1
+                        queue.append(predecessor)
+            self._remaining = array('I', (self.END if r is None else r
+                                          for r in remaining))
+        return self._remaining
+
+    def generate_word(self, rng=random, max_length=None):
+        """Generate a word by walking the chain from a random initial pair
+
+        Give up, returning None, as soon as the word can't end up being
+        at most max_length long."""
+        remaining = self.remaining() if max_length is not None else None
+        state = self.inits[rng.randrange(len(self.inits))]
+        word = [self.pair(state)]
+        length = 2
+        while True:
+            if remaining is not None and \
+               length + remaining[state] > max_length:
+                return None
+            start = self.offsets[state]
+            end = self.offsets[state + 1]
+            e = bisect_right(self.cumulative,
+                             rng.randrange(self.cumulative[end - 1]),
+                             start, end)
+            state = self.next_states[e]
+            if state == self.END:
+                return ''.join(word)
+            word.append(self.alphabet[self.chars[e]])
+            length += 1
+
+    def iter_words(self, min_length, max_length, rng=random):
+        """Generate words of min_length to max_length letters, forever"""
+        while True:
+            word = self.generate_word(rng, max_length)
+            if word is not None and len(word) >= min_length:
+                yield word
+
+    def iter_words_batched(self, min_length, max_length, batch_size,
+                           seed=None):
+        """Generate words of min_length to max_length letters, forever,
+        walking batch_size chains at a time with NumPy
+
+        Words are yielded in the order their chains were started, so the
+        words are distributed as with iter_words(), up to the rounding
+        of floating point random numbers."""
+        import numpy
+        rng = numpy.random.RandomState(seed)
+        offsets = numpy.array(self.offsets, dtype=numpy.int64)
+        cumulative = numpy.array(self.cumulative, dtype=numpy.int64)
+        totals = cumulative[offsets[1:] - 1]
+        # Make cumulative weights global, so that a single binary search
+        # finds the edges of all chains, whatever their state
+        bases = numpy.concatenate(([0], numpy.cumsum(totals)[:-1]))
+        global_cumulative = cumulative + numpy.repeat(
+            bases, offsets[1:] - offsets[:-1])
+        next_states = numpy.array(self.next_states, dtype=numpy.int64)
+        next_states[next_states == self.END] = -1
+        chars = numpy.array(self.chars, dtype=numpy.int64)
+        pair_chars = numpy.array(self.pair_chars, dtype=numpy.int64)
+        inits = numpy.array(self.inits, dtype=numpy.int64)
+        remaining = numpy.array(self.remaining(), dtype=numpy.int64)
+        # Reaching END needs no more letter
+        remaining = numpy.concatenate((remaining, [0]))
+        alphabet = self.alphabet
+
+        letters = numpy.zeros((batch_size, max(max_length, 2)),
+                              dtype=numpy.int64)
+        states = numpy.zeros(batch_size, dtype=numpy.int64)
+        lengths = numpy.zeros(batch_size, dtype=numpy.int64)
+        chain_ids = numpy.zeros(batch_size, dtype=numpy.int64)
+        next_chain_id = 0
+        next_output_id = 0
+        # Chain id -> word, or None if the chain was discarded
+        finished = {}
+
+        def start(rows):
+            nonlocal next_chain_id
+            new_states = inits[rng.randint(0, len(inits), size=len(rows))]
+            states[rows] = new_states
+            letters[rows, 0] = pair_chars[2 * new_states]
+            letters[rows, 1] = pair_chars[2 * new_states + 1]
+            lengths[rows] = 2
+            chain_ids[rows] = numpy.arange(next_chain_id,
+                                           next_chain_id + len(rows))
+            next_chain_id += len(rows)
+
+        start(numpy.arange(batch_size))
+        while True:
+            r = (rng.random_sample(batch_size) * totals[states]).astype(
+                numpy.int64)
+            e = numpy.searchsorted(global_cumulative, bases[states] + r,
+                                   side='right')
+            new_states = next_states[e]
+            ended = new_states < 0
+            # Chains that can't end up short enough anymore are discarded
+            alive = ~ended & (lengths + 1 + remaining[new_states]
+                              <= max_length)
+            for row in numpy.nonzero(ended)[0]:
+                finished[chain_ids[row]] = \
+                    ''.join([alphabet[c]
+                             for c in letters[row, :lengths[row]]]) \
+                    if lengths[row] >= min_length else None
+            for row in numpy.nonzero(~ended & ~alive)[0]:
+                finished[chain_ids[row]] = None
+            while next_output_id in finished:
+                word = finished.pop(next_output_id)
+                next_output_id += 1
+                if word is not None:
+                    yield word
+            rows = numpy.nonzero(alive)[0]
+            letters[rows, lengths[rows]] = chars[e[rows]]
+            lengths[rows] += 1
+            states[rows] = new_states[rows]
+            start(numpy.nonzero(~alive)[0])
+
 class Pseudolanguage:
 
     def __init__(self, **dict):
@@ -45,69 +302,141 @@ class Pseudolanguage:
         dict.setdefault('name', '')
         self.name = dict['name']
         self.parsed = False
+        # Each file's counts, as returned by count()
         self.data = {}
-        self.inits = {}
+        # The sum of all files' counts
+        self.inits = Counter()
         self.pairs = {}
+        # The pairs whose counts changed since the last parse()
+        self.dirty = set()
+        # Pair -> sorted list of (successor, count)
+        self.successors = {}
+        self.model = None
+
+    @staticmethod
+    def count(f):
+        """Count how many words of a file start with each pair, and how
+        many times each pair is followed by each letter"""
+        inits = Counter()
+        pairs = {}
+        with open(f) as text:
+            for line in text:
+                line = re.sub(r"#.*", "", line)
+                for word in line.split():
+                    word += ' '
+                    if len(word) > 3:
+                        inits[word[0:2]] += 1
+                    pos = 0
+                    while pos < len(word)-2:
+                        successors = pairs.get(word[pos:pos+2])
+                        if successors is None:
+                            successors = pairs[word[pos:pos+2]] = Counter()
+                        successors[word[pos+2]] += 1
+                        pos = pos + 1
+        return inits, pairs
+
+    def add_counts(self, counts, sign):
+        """Add (sign=1) or subtract (sign=-1) a file's counts"""
+        inits, pairs = counts
+        for pair, count in inits.items():
+            self.inits[pair] += sign * count
+            if not self.inits[pair]:
+                del self.inits[pair]
+        for pair, successors in pairs.items():
+            total = self.pairs.setdefault(pair, Counter())
+            for c, count in successors.items():
+                total[c] += sign * count
+                if not total[c]:
+                    del total[c]
+            if not total:
+                del self.pairs[pair]
+            self.dirty.add(pair)
 
     def incorporate(self, files):
         """Load list of files for this pseudolanguage into self.data"""
         self.parsed = False
         for f in files:
-            words = []
-            with open(f) as text:
-                for line in text:
-                    line = line.strip()
-                    line = re.sub(r"#.*", "", line)
-                    words.extend(re.split(r"\s+", line))
-                self.data[f] = words
+            counts = self.count(f)
+            if f in self.data:
+                self.add_counts(self.data[f], -1)
+            self.data[f] = counts
+            self.add_counts(counts, 1)
 
     def delete(self, files):
         """Delete a list of languages from self.data"""
         self.parsed = False
         for f in files:
-            del self.data[f]
+            self.add_counts(self.data.pop(f), -1)
 
     def parse(self):
-        """Parse pseudolanguage's data into self.inits and self.pairs"""
+        """Compile pseudolanguage's data into self.model, only updating
+        the successors of the pairs whose counts changed"""
         if not self.parsed:
-            self.inits.clear()
-            self.pairs.clear()
-            for f in self.data:
-                for word in self.data[f]:
-                    word += ' '
-                    if len(word) > 3:
-                        if word[0:2] in self.inits:
-                            self.inits[word[0:2]].append(word[2:3])
-                        else:
-                            self.inits[word[0:2]] = [word[2:3]]
-                    pos = 0
-                    while pos < len(word)-2:
-                        if word[pos:pos+2] in self.pairs:
-                            self.pairs[word[pos:pos+2]].append(word[pos+2])
-                        else:
-                            self.pairs[word[pos:pos+2]] = [word[pos+2]]
-                        pos = pos + 1
+            for pair in self.dirty:
+                if pair in self.pairs:
+                    self.successors[pair] = sorted(self.pairs[pair].items())
+                else:
+                    self.successors.pop(pair, None)
+            self.dirty.clear()
+            self.model = CompiledModel.from_counts(self.inits,
+                                                   self.successors)
             self.parsed = True
- 
+
+    def load(self, path):
+        """Load a compiled pseudolanguage, instead of any data"""
+        self.__init__(name=self.name)
+        self.model = CompiledModel.load(path)
+        self.parsed = True
+
+    def save(self, path):
+        """Save the compiled pseudolanguage"""
+        self.parse()
+        self.model.save(path)
+
     def dump(self):
         """Print the current parsed data; use pickle for inflatable dumps"""
         self.parse()
+        states = range(len(self.model.offsets) - 1)
         print('name = """', self.name, '"""')
-        print("dump = { 'inits': ", self.inits, ",")
-        print("'pairs': ", self.pairs, " }")
+        print("dump = { 'inits': ",
+              [self.model.pair(state) for state in self.model.inits], ",")
+        print("'pairs': ",
+              dict((self.model.pair(state), self.model.successors(state))
+                   for state in states), " }")
 
     def generate(self, number, min, max):
         """Generate list of words of min and max lengths"""
+        return list(self.iter_generate(number, min, max))
+
+    def iter_generate(self, number, min, max, seed=None, batch_size=4096):
+        """Generate words of min and max lengths, as they come
+
+        With NumPy, up to batch_size words are generated at the same
+        time. A seed makes the words reproducible."""
         self.parse()
-        wordlist = []
-        while len(wordlist) < number:
-            word = random.choice(list(self.inits.keys()))
-            while word.find(' ') == -1:
-                word += random.choice(self.pairs[word[-2:]])
-            word = word.strip()
-            if len(word) >= min and len(word) <= max:
-                wordlist.append(word)
-        return wordlist
+        remaining = self.model.remaining()
+        if not number:
+            return
+        if min > max or all(2 + remaining[state] > max
+                            for state in self.model.inits):
+            raise ValueError("no word can be %d to %d letters long"
+                             % (min, max))
+        # NumPy only pays off when generating many words
+        numpy = None
+        if number > 1:
+            try:
+                import numpy
+            except ImportError:
+                pass
+        if numpy is not None:
+            words = self.model.iter_words_batched(
+                min, max, batch_size=batch_size if batch_size < 2 * number
+                else 2 * number, seed=seed)
+        else:
+            rng = random.Random(seed) if seed is not None else random
+            words = self.model.iter_words(min, max, rng)
+        for _, word in zip(range(number), words):
+            yield word
 
 if __name__ == '__main__':
 
@@ -124,13 +453,27 @@ if __name__ == '__main__':
                      help="Set the maximum length of each word")
     parser.add_option("--name", dest="name", default=' ',
                      help="Set the name of the pseudolanguage")
+    parser.add_option("-c", "--compile", dest="compile", metavar="FILE",
+                     help="Save the compiled pseudolanguage to FILE")
+    parser.add_option("-l", "--load", dest="load", metavar="FILE",
+                     help="Load the compiled pseudolanguage from FILE "
+                          "instead of datafiles")
+    parser.add_option("--seed", type="int", dest="seed",
+                     help="Seed the random number generator, to generate "
+                          "the same words every time")
     (options, args) = parser.parse_args()
 
     aLanguage = Pseudolanguage(name=options.name)
-    aLanguage.incorporate(args)
-    if options.dump:
+    if options.load:
+        aLanguage.load(options.load)
+    else:
+        aLanguage.incorporate(args)
+    if options.compile:
+        aLanguage.save(options.compile)
+    elif options.dump:
         aLanguage.dump()
     else:
-        results = aLanguage.generate(options.num, options.min, options.max)
+        results = aLanguage.iter_generate(options.num, options.min,
+                                          options.max, seed=options.seed)
         for word in results:
             print(word)
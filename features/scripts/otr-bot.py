@@ -3,7 +3,9 @@ import sys
 import jabberbot
 import xmpp
 import potr
+import collections
 import logging
+import time
 from argparse import ArgumentParser
 
 class OtrContext(potr.context.Context):
@@ -22,6 +24,10 @@ class OtrContext(potr.context.Context):
 
 class BotAccount(potr.context.Account):
 
+    # Parsed private keys, by key file path, shared by all accounts
+    # using the same key file: parsing one is slow.
+    privkeys = {}
+
     def __init__(self, jid, keyFilePath):
         protocol = 'xmpp'
         max_message_size = 10*1024
@@ -29,36 +35,85 @@ class BotAccount(potr.context.Account):
         self.keyFilePath = keyFilePath
 
     def loadPrivkey(self):
-        with open(self.keyFilePath, 'rb') as keyFile:
-            return potr.crypt.PK.parsePrivateKey(keyFile.read())[0]
+        if self.keyFilePath not in BotAccount.privkeys:
+            with open(self.keyFilePath, 'rb') as keyFile:
+                BotAccount.privkeys[self.keyFilePath] = \
+                    potr.crypt.PK.parsePrivateKey(keyFile.read())[0]
+        return BotAccount.privkeys[self.keyFilePath]
 
 
+# Keeps at most max_contexts OTR contexts, and none that has not been
+# used for idle_timeout seconds (None means no limit), evicting the
+# least recently used ones first. Contexts in the middle of an AKE
+# are only evicted once idle, so that more peers than max_contexts
+# starting OTR at the same time do not break each other's handshake.
+# Evicted contexts are passed to on_evict, e.g. to end their OTR
+# session.
 class OtrContextManager:
 
-    def __init__(self, jid, keyFilePath):
+    def __init__(self, jid, keyFilePath, max_contexts = None,
+                 idle_timeout = None, on_evict = None):
         self.account = BotAccount(jid, keyFilePath)
-        self.contexts = {}
+        # Load the key now rather than during the first AKE, so a bad
+        # key file is reported on start.
+        self.account.getPrivkey()
+        self.max_contexts = max_contexts
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        # Least recently used first
+        self.contexts = collections.OrderedDict()
 
     def start_context(self, other):
-        if not other in self.contexts:
-            self.contexts[other] = OtrContext(self.account, other)
-        return self.contexts[other]
+        now = time.time()
+        otrctx = self.contexts.pop(other, None)
+        if otrctx is None:
+            otrctx = OtrContext(self.account, other)
+        otrctx.last_used = now
+        self.contexts[other] = otrctx
+        self.expire(now, keep = other)
+        return otrctx
 
     def get_context_for_user(self, other):
         return self.start_context(other)
 
+    def expire(self, now = None, keep = None):
+        if now is None:
+            now = time.time()
+        excess = 0
+        if self.max_contexts is not None:
+            excess = len(self.contexts) - self.max_contexts
+        evicted = []
+        for other, otrctx in self.contexts.iteritems():
+            idle = self.idle_timeout is not None and \
+                now - otrctx.last_used > self.idle_timeout
+            if not idle and excess <= 0:
+                break
+            if other == keep:
+                continue
+            if idle or otrctx.crypto.ake is None:
+                evicted.append(other)
+                excess -= 1
+        for other in evicted:
+            otrctx = self.contexts.pop(other)
+            if self.on_evict:
+                self.on_evict(otrctx)
+
 
 class OtrBot(jabberbot.JabberBot):
 
     PING_FREQUENCY = 60
 
     def __init__(self, account, password, otr_key_path,
-                 connect_server = None, log_file = None):
+                 connect_server = None, log_file = None,
+                 max_otr_contexts = None, otr_idle_timeout = None):
         self.__connect_server = connect_server
         self.__password = password
         self.__log_file = log_file
         super(OtrBot, self).__init__(account, password)
-        self.__otr_manager = OtrContextManager(account, otr_key_path)
+        self.__otr_manager = OtrContextManager(
+            account, otr_key_path, max_contexts = max_otr_contexts,
+            idle_timeout = otr_idle_timeout,
+            on_evict = self.__end_evicted_otr_session)
         self.send_raw_message_fn = super(OtrBot, self).send_message
         self.__default_otr_appdata = {
             "send_raw_message_fn": self.send_raw_message_fn
@@ -69,6 +124,18 @@ class OtrBot(jabberbot.JabberBot):
         appdata["base_reply"] = mess
         return appdata
 
+    # Tell the peer when we forget about an OTR session, so it starts
+    # a new one instead of sending messages we cannot decrypt anymore.
+    def __end_evicted_otr_session(self, otrctx):
+        if otrctx.state != potr.context.STATE_ENCRYPTED:
+            return
+        mess = xmpp.Message(to = otrctx.peer, typ = "chat")
+        try:
+            otrctx.disconnect(appdata = self.__otr_appdata_for_mess(mess))
+        except Exception:
+            logging.exception("Failed to end the OTR session with %s",
+                              otrctx.peer)
+
     # Unfortunately Jabberbot's connect() is not very friendly to
     # overriding in subclasses so we have to re-implement it
     # completely (copy-paste mostly) in order to add support for using
@@ -140,6 +207,11 @@ class OtrBot(jabberbot.JabberBot):
         mess.setBody(decrypted_body)
         super(OtrBot, self).callback_message(conn, mess)
 
+    # Also evict idle OTR contexts when no message comes in.
+    def idle_proc(self):
+        super(OtrBot, self).idle_proc()
+        self.__otr_manager.expire()
+
     # Override Jabberbot quitting on keep alive failure.
     def on_ping_timeout(self):
         self.__lastping = None
@@ -177,6 +249,154 @@ class OtrBot(jabberbot.JabberBot):
             self.__otr_appdata_for_mess(mess.buildReply()))
         return ""
 
+# Stands in for the XMPP server and the bot's xmpp.Client connection
+# in benchmark mode: stanzas are delivered in order, to the handler
+# registered for their recipient's bare JID, when process() is called.
+class LoopbackConnection:
+
+    def __init__(self, server_jid):
+        self.server_jid = server_jid
+        self.handlers = {}
+        self.queue = collections.deque()
+
+    def register(self, jid, handler):
+        self.handlers[jid] = handler
+
+    def send(self, stanza):
+        # Like sending it over the wire, so that the sender can reuse
+        # the stanza, as OtrContext.inject() does with fragments.
+        mess = xmpp.Message(node = stanza)
+        if not mess.getFrom():
+            mess.setFrom(self.server_jid)
+        self.queue.append(mess)
+
+    def process(self):
+        while self.queue:
+            mess = self.queue.popleft()
+            self.handlers[mess.getTo().getStripped()](mess)
+
+
+# An OTR-capable chat client talking to the bot in benchmark mode. It
+# uses the bot's key, which is loaded only once anyway.
+class SimulatedPeer:
+
+    def __init__(self, jid, bot_jid, otr_key_path, connection):
+        self.jid = xmpp.JID(jid)
+        self.bot_jid = bot_jid
+        self.connection = connection
+        self.account = BotAccount(self.jid.getStripped(), otr_key_path)
+        self.otrctx = OtrContext(self.account, bot_jid)
+        self.handshake_start = None
+        self.handshake_latency = None
+        self.replies = 0
+
+    def __new_message(self, body = None):
+        return xmpp.Message(to = self.bot_jid, frm = self.jid, typ = "chat",
+                            body = body)
+
+    def __appdata(self):
+        return {
+            "base_reply": self.__new_message(),
+            "send_raw_message_fn": self.connection.send,
+            }
+
+    def encrypted(self):
+        return self.otrctx.state == potr.context.STATE_ENCRYPTED
+
+    def start_otr(self):
+        self.handshake_start = time.time()
+        query = self.account.getDefaultQueryMessage(self.otrctx.getPolicy)
+        self.connection.send(self.__new_message(query))
+
+    def say(self, text):
+        self.otrctx.sendMessage(potr.context.FRAGMENT_SEND_ALL,
+                                "say " + text, appdata = self.__appdata())
+
+    def receive(self, mess):
+        body = mess.getBody().encode('utf-8')
+        try:
+            decrypted_body, tlvs = self.otrctx.receiveMessage(
+                body, appdata = self.__appdata())
+        except potr.context.NotOTRMessage:
+            decrypted_body = body
+        except potr.context.UnencryptedMessage:
+            return
+        if self.encrypted() and self.handshake_latency is None:
+            self.handshake_latency = time.time() - self.handshake_start
+        if decrypted_body:
+            self.replies += 1
+
+
+# Drives many simulated peers against the bot, first through
+# concurrent OTR handshakes, then through rounds of encrypted "say"
+# commands, without any network or XMPP server involved. The time
+# spent handling messages in the bot itself is reported separately
+# from the wall clock time, which includes the peers' work.
+def run_benchmark(args, otr_bot_opt_args):
+    # OtrBot.connect() would log every stanza
+    logging.basicConfig(filename = args.log_file, level = logging.WARNING)
+    otr_bot = OtrBot(args.account, args.password, args.otr_key_path,
+                     **otr_bot_opt_args)
+    bot_jid = otr_bot.jid.getStripped()
+    connection = LoopbackConnection(bot_jid)
+    otr_bot.conn = connection
+    bot_stats = {"messages": 0, "time": 0.0}
+
+    def deliver_to_bot(mess):
+        start = time.time()
+        otr_bot.callback_message(connection, mess)
+        bot_stats["time"] += time.time() - start
+        bot_stats["messages"] += 1
+
+    connection.register(bot_jid, deliver_to_bot)
+    peers = []
+    for i in range(args.benchmark):
+        peer = SimulatedPeer("peer%d@benchmark.invalid/bench" % i, bot_jid,
+                             args.otr_key_path, connection)
+        connection.register(peer.jid.getStripped(), peer.receive)
+        # Jabberbot ignores messages from peers it has not seen online
+        otr_bot.callback_presence(connection, xmpp.Presence(frm = peer.jid))
+        peers.append(peer)
+
+    start = time.time()
+    for peer in peers:
+        peer.start_otr()
+    connection.process()
+    handshake_time = time.time() - start
+    latencies = sorted(peer.handshake_latency for peer in peers
+                       if peer.handshake_latency is not None)
+    print("Handshakes: %d/%d completed in %.2f s, bot busy %.2f s"
+          % (len(latencies), len(peers), handshake_time, bot_stats["time"]))
+    if latencies:
+        print("Handshake latency: min %.3f s, median %.3f s, max %.3f s"
+              % (latencies[0], latencies[len(latencies) // 2],
+                 latencies[-1]))
+
+    bot_stats["messages"] = 0
+    bot_stats["time"] = 0.0
+    sent = 0
+    start = time.time()
+    for n in range(args.benchmark_messages):
+        for peer in peers:
+            if peer.encrypted():
+                peer.say("message %d" % n)
+                sent += 1
+        connection.process()
+    message_time = time.time() - start
+    replies = sum(peer.replies for peer in peers)
+    print("Messages: %d sent, %d replies in %.2f s"
+          % (sent, replies, message_time))
+    if replies:
+        print("Round trips: %.1f/s" % (replies / message_time))
+    if bot_stats["messages"]:
+        print("Bot: %d messages handled in %.2f s (%.1f messages/s)"
+              % (bot_stats["messages"], bot_stats["time"],
+                 bot_stats["messages"] / bot_stats["time"]))
+    ended = sum(1 for peer in peers
+                if peer.otrctx.state == potr.context.STATE_FINISHED)
+    print("OTR sessions ended by the bot: %d" % ended)
+
+
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument("account",
@@ -192,12 +412,34 @@ if __name__ == '__main__':
                         help = "auto-join multi-user chatrooms on start")
     parser.add_argument("-l", "--log-file", metavar = 'LOGFILE',
                         help = "Log to file instead of stderr")
+    parser.add_argument("--max-otr-contexts", type = int, default = 100,
+                        metavar = 'N',
+                        help = "forget the OTR sessions with the least " +
+                        "recently active peers beyond N (0 means no limit)")
+    parser.add_argument("--otr-idle-timeout", type = int, default = 3600,
+                        metavar = 'SECONDS',
+                        help = "forget the OTR sessions with peers inactive " +
+                        "for that long (0 means no limit)")
+    parser.add_argument("-b", "--benchmark", type = int, metavar = 'PEERS',
+                        help = "instead of connecting, measure the OTR " +
+                        "handshake latency and message throughput with " +
+                        "PEERS simulated peers (the password is unused)")
+    parser.add_argument("--benchmark-messages", type = int, default = 100,
+                        metavar = 'N',
+                        help = "messages sent by each peer in benchmark mode")
     args = parser.parse_args()
     otr_bot_opt_args = dict()
     if args.connect_server:
         otr_bot_opt_args["connect_server"] = args.connect_server
     if args.log_file:
         otr_bot_opt_args["log_file"] = args.log_file
+    if args.max_otr_contexts > 0:
+        otr_bot_opt_args["max_otr_contexts"] = args.max_otr_contexts
+    if args.otr_idle_timeout > 0:
+        otr_bot_opt_args["otr_idle_timeout"] = args.otr_idle_timeout
+    if args.benchmark:
+        run_benchmark(args, otr_bot_opt_args)
+        sys.exit(0)
     otr_bot = OtrBot(args.account, args.password, args.otr_key_path,
                      **otr_bot_opt_args)
     if args.auto_join:
@@ -1,7 +1,9 @@
 require 'base64'
+require 'digest'
 require 'json'
 require 'socket'
 require 'timeout'
+require 'zlib'
 
 module RemoteShell
   class ServerFailure < StandardError
@@ -16,10 +18,114 @@ module RemoteShell
 
   DEFAULT_TIMEOUT = 20*60
 
+  # Binary data in a request, which version 1 of the protocol sends
+  # base64-encoded.
+  Binary = Struct.new(:data)
+
+  # Version 2 of the protocol: length-prefixed frames instead of JSON
+  # lines, with raw binary fields. See FramedProtocol in
+  # tails-autotest-remote-shell for the details.
+  module Framed
+    MAGIC = 0
+    HEADER = 'CNCCN'
+    HEADER_SIZE = 11
+    FIELD_HEADER = 'CN'
+    FIELD_JSON, FIELD_BINARY, FIELD_TEXT = 0, 1, 2
+    FLAG_ZLIB = 1
+    FLAG_ACCEPT_ZLIB = 2
+    FLAG_TIMINGS = 4
+    COMMAND_TYPES = [
+      'protocol_versions', 'sh_call', 'sh_spawn', 'python_execute',
+      'file_read', 'file_write', 'file_append', 'file_digest',
+      'file_read_chunk', 'file_write_chunk', 'refresh_env', 'stats',
+    ]
+    STATUSES = ['success', 'error']
+
+    def self.encode_request(id, cmd_type, *args, timings: false)
+      payload = args.map do |arg|
+        if arg.class == Binary
+          kind, data = FIELD_BINARY, arg.data.b
+        else
+          kind, data = FIELD_JSON, JSON.dump(arg).b
+        end
+        [kind, data.size].pack(FIELD_HEADER) + data
+      end.join.b
+      flags = 0
+      deflated = Zlib::Deflate.deflate(payload)
+      if deflated.size < payload.size
+        payload, flags = deflated, FLAG_ZLIB
+      end
+      flags |= FLAG_ACCEPT_ZLIB
+      flags |= FLAG_TIMINGS if timings
+      [MAGIC, id, COMMAND_TYPES.index(cmd_type), flags, payload.size]
+        .pack(HEADER) + payload
+    end
+
+    def self.read_response(socket)
+      _, id, status, flags, size = socket.read(HEADER_SIZE).unpack(HEADER)
+      payload = size > 0 ? socket.read(size) : ''.b
+      payload = Zlib::Inflate.inflate(payload) if flags & FLAG_ZLIB != 0
+      values = []
+      offset = 0
+      while offset < payload.size
+        kind, length = payload.byteslice(offset, 5).unpack(FIELD_HEADER)
+        data = payload.byteslice(offset + 5, length)
+        offset += 5 + length
+        values << case kind
+                  when FIELD_JSON then JSON.load(data.force_encoding('utf-8'))
+                  when FIELD_BINARY then data
+                  else data.force_encoding('utf-8')
+                  end
+      end
+      timings = flags & FLAG_TIMINGS != 0 ? values.pop : nil
+      return [id, STATUSES[status], timings] + values
+    end
+  end
+
   # Counter providing unique id:s for each communicate() call.
   @@request_id ||= 0
 
+  # The protocol version used with the current VM, which we learn
+  # the first time we talk to it.
+  @@protocol_version ||= nil
+
+  def reset_protocol_version
+    @@protocol_version = nil
+  end
+
+  def protocol_version(vm)
+    return @@protocol_version if @@protocol_version
+    begin
+      versions = communicate_with_version(vm, 1, 'protocol_versions',
+                                          timeout: 10)
+    rescue Timeout
+      raise
+    rescue ServerFailure
+      # This remote shell predates protocol negotiation.
+      versions = [1]
+    end
+    @@protocol_version = versions.include?(2) ? 2 : 1
+  end
+
+  # The timings of the last request sent with the :timings option,
+  # which only version 2 of the protocol supports.
+  @@last_timings ||= nil
+
+  def last_timings
+    @@last_timings
+  end
+
+  # Returns the remote shell's aggregate statistics about the requests
+  # it has handled, optionally resetting them.
+  def stats(vm, reset = false)
+    communicate(vm, 'stats', reset).first
+  end
+
   def communicate(vm, *args, **opts)
+    communicate_with_version(vm, protocol_version(vm), *args, **opts)
+  end
+
+  def communicate_with_version(vm, version, *args, **opts)
     opts[:timeout] ||= DEFAULT_TIMEOUT
     socket = TCPSocket.new("127.0.0.1", vm.get_remote_shell_port)
     id = (@@request_id += 1)
@@ -28,11 +134,24 @@ module RemoteShell
     # class from the 'timeout' module. However, note that we want it
     # to throw our own Timeout exception.
     Object::Timeout.timeout(opts[:timeout], Timeout) do
-      socket.puts(JSON.dump([id] + args))
+      if version == 2
+        socket.write(Framed.encode_request(id, *args,
+                                           timings: !!opts[:timings]))
+      else
+        args = args.map do |arg|
+          arg.class == Binary ? Base64.strict_encode64(arg.data) : arg
+        end
+        socket.puts(JSON.dump([id] + args))
+      end
       socket.flush
       loop do
-        line = socket.readline("\n").chomp("\n")
-        response_id, status, *rest = JSON.load(line)
+        if version == 2
+          response_id, status, timings, *rest = Framed.read_response(socket)
+          @@last_timings = timings if response_id == id
+        else
+          line = socket.readline("\n").chomp("\n")
+          response_id, status, *rest = JSON.load(line)
+        end
         if response_id == id
           if status != "success"
             if status == "error" and rest.class == Array and rest.size == 1
@@ -53,8 +172,10 @@ module RemoteShell
     socket.close if defined?(socket) && socket
   end
 
-  module_function :communicate
-  private :communicate
+  module_function :communicate, :communicate_with_version,
+                  :protocol_version, :reset_protocol_version,
+                  :last_timings, :stats
+  private :communicate, :communicate_with_version, :protocol_version
 
   class ShellCommand
     # If `:spawn` is false the server will block until it has finished
@@ -138,16 +259,59 @@ module RemoteShell
   end
 
   # An IO-like object that is more or less equivalent to a File object
-  # opened in rw mode.
+  # opened in rw mode. Files are transferred in zlib-compressed chunks
+  # whose digests are verified on both ends, except with remote shells
+  # that predate that, e.g. when testing upgrades from an older Tails.
   class File
+    CHUNK_SIZE = 256*1024
+    READ_CACHE_SIZE = 16*1024*1024
+
+    # The digest and content of the files we have read most recently,
+    # up to READ_CACHE_SIZE bytes in total, so we don't transfer them
+    # again while they are unchanged.
+    @@read_cache ||= {}
+    @@read_cache_size ||= 0
+
     def self.open(vm, mode, path, *args, **opts)
       debug_log("opening file #{path} in '#{mode}' mode")
       ret = RemoteShell.communicate(vm, 'file_' + mode, path, *args, **opts)
-      if ret.size != 1
-        raise ServerFailure.new("expected 1 value but got #{ret.size}")
-      end
       debug_log("#{mode} complete")
-      return ret.first
+      return ret
+    end
+
+    # Binary data is sent base64-encoded by version 1 of the protocol,
+    # and as a binary string by version 2.
+    def self.binary(value)
+      value.encoding == Encoding::BINARY ? value : Base64.decode64(value)
+    end
+
+    def self.check_digest(data, digest, what)
+      if Digest::SHA256.hexdigest(data) != digest
+        raise ServerFailure.new("digest mismatch for #{what}")
+      end
+    end
+
+    def self.cached(path, digest)
+      cached_digest, data = @@read_cache[path]
+      return nil if cached_digest != digest
+      # Move it to the end, where the most recently used files are
+      @@read_cache[path] = @@read_cache.delete(path)
+      data
+    end
+
+    def self.cache(path, digest, data)
+      uncache(path)
+      return if data.size > READ_CACHE_SIZE
+      while @@read_cache_size + data.size > READ_CACHE_SIZE
+        uncache(@@read_cache.first.first)
+      end
+      @@read_cache[path] = [digest, data]
+      @@read_cache_size += data.size
+    end
+
+    def self.uncache(path)
+      _, data = @@read_cache.delete(path)
+      @@read_cache_size -= data.size if data
     end
 
     attr_reader :vm, :path
@@ -156,16 +320,93 @@ module RemoteShell
       @vm, @path = vm, path
     end
 
+    # Returns the size of the file and the SHA-256 digest of `length`
+    # bytes of it starting at `offset` (by default: all of it).
+    def digest(offset = 0, length = nil)
+      self.class.open(@vm, 'digest', @path, offset, length)
+    end
+
     def read()
-      Base64.decode64(self.class.open(@vm, 'read', @path)).force_encoding('utf-8')
+      data = chunked { read_chunks } ||
+             self.class.binary(self.class.open(@vm, 'read', @path).first)
+      data.dup.force_encoding('utf-8')
     end
 
     def write(data)
-      self.class.open(@vm, 'write', @path, Base64.encode64(data))
+      chunked { write_chunks(data, 0) } ||
+        self.class.open(@vm, 'write', @path, Binary.new(data.b)).first
     end
 
     def append(data)
-      self.class.open(@vm, 'append', @path, Base64.encode64(data))
+      chunked { write_chunks(data, nil) } ||
+        self.class.open(@vm, 'append', @path, Binary.new(data.b)).first
+    end
+
+    private
+
+    # Returns the value of the block, or nil if the remote shell does
+    # not support chunked transfers: remote shells that predate them
+    # only speak version 1 of the protocol, and reject their commands.
+    def chunked
+      return nil if RemoteShell.protocol_version(@vm) < 2
+      yield
+    rescue Timeout
+      raise
+    rescue ServerFailure => e
+      raise unless e.message.include?('unknown command type')
+      nil
+    end
+
+    # Reads as many bytes as the file had when we got its digest: if
+    # it grows meanwhile, we return the snapshot that was digested.
+    def read_chunks
+      size, digest = self.digest
+      data = self.class.cached(@path, digest)
+      if data.nil?
+        data = ''.b
+        while data.size < size
+          payload, compressed, chunk_digest, _ = self.class.open(
+            @vm, 'read_chunk', @path, data.size,
+            [CHUNK_SIZE, size - data.size].min, true
+          )
+          chunk = self.class.binary(payload)
+          chunk = Zlib::Inflate.inflate(chunk) if compressed
+          self.class.check_digest(chunk, chunk_digest,
+                                  "chunk at offset #{data.size} of #{@path}")
+          # The file was truncated while we were reading it, which
+          # the check below will catch.
+          break if chunk.empty?
+          data << chunk
+        end
+        self.class.check_digest(data, digest, @path)
+        self.class.cache(@path, digest, data)
+      end
+      data
+    end
+
+    # Writes `data` at `offset`, or at the end of the file if `offset`
+    # is nil, truncating the file after it in the former case. Each
+    # chunk is written at a fixed offset (except when appending), so
+    # a failed chunk can be sent again.
+    def write_chunks(data, offset)
+      self.class.uncache(@path)
+      data = data.b
+      pos = 0
+      loop do
+        chunk = data.byteslice(pos, CHUNK_SIZE)
+        last = pos + chunk.size >= data.size
+        payload = Zlib::Deflate.deflate(chunk)
+        compressed = payload.size < chunk.size
+        payload = chunk unless compressed
+        self.class.open(
+          @vm, 'write_chunk', @path, offset && offset + pos,
+          Binary.new(payload), compressed,
+          Digest::SHA256.hexdigest(chunk), last && !offset.nil?
+        )
+        pos += chunk.size
+        break if last
+      end
+      return data.size
     end
   end
 end
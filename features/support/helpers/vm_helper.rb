@@ -458,6 +458,8 @@ class VM
   end
 
   def wait_until_remote_shell_is_up(timeout = 90)
+    # We may be talking to a different version of Tails now.
+    RemoteShell.reset_protocol_version
     try_for(timeout, :msg => "Remote shell seems to be down") do
       remote_shell_is_up?
     end